@@ -10,7 +10,7 @@ HOST, PORT = "localhost", 9999
 def send_command(command):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
         sock.connect((HOST, PORT))
-        sock.sendall(command.encode('utf-8'))
+        sock.sendall((command + "\n").encode('utf-8'))
         received = str(sock.recv(1024), "utf-8")
         return received.strip()
 
@@ -18,3 +18,7 @@ print("Putting a value...")
 print(send_command("PUT key1 value_one"))
 print("Reading a value...")
 print(send_command("READ key1"))
+print("Putting a batch of values...")
+print(send_command("BATCHPUT 2\nkey2 value_two\nkey3 value_three"))
+print("Reading a range of keys...")
+print(send_command("READRANGE key1 key3"))
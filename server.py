@@ -4,22 +4,43 @@
 # It listens on a network port, waits for requests, and processes them.
 #
 
+import asyncio
+import mmap
 import os
 import struct
-import json
-import socketserver
+import queue
+import socket
 import threading
 import time
+import zlib
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import orjson
+from sortedcontainers import SortedDict
 
 # --- Configuration ---
 HOST, PORT = "localhost", 9999
 
 DATA_FILE = "store.dat"
-COMPACTION_THRESHOLD = 0.5  # If half the file is old, overwritten data, I'll clean it up.
+COMPACTION_THRESHOLD_SHIFT = 1  # Once garbage passes data_size >> 1 (half the data), I'll clean it up.
+COMPACTION_MIN_GROWTH = 1 << 20  # And the store has to grow this much since the last cleanup before I check again.
+SEGMENT_MAX_SIZE = 64 << 20  # Once the active segment is this big, I seal it and start a new one.
+PREALLOCATE_CHUNK = 16 << 20  # The active segment grows on disk in steps this big.
+IOV_MAX = 1024  # POSIX promises at least this many buffers per writev call.
+WRITEV_MAX_BYTES = 1 << 30  # And I keep each call under 1 GiB so the kernel never caps it for me.
+MAX_LINE_SIZE = 64 << 20  # Longest command line (or batch line) a client may send.
+RANGE_READ_MAX_GAP = 4096  # READRANGE reads straight through gaps this small rather than making another call.
+MERGE_BUFFER_SIZE = 8 << 20  # Compaction copies live entries in reads and writes about this big.
+CACHE_MAX_BYTES = 64 << 20  # How much recently used data I keep in memory to skip disk reads.
+GROUP_COMMIT_MAX_JOBS = 1024  # Most queued writes I'll fold into one writev + fdatasync.
+# Threads that run reads, so the event loop never waits on the disk. Writes don't use them
+# (they wait on a future instead), and reads mostly wait on I/O, so I keep a few more than there are cores.
+WORKER_THREADS = min(32, (os.cpu_count() or 1) + 4)
 
 # --- The communication protocol ---
 # I'm using a simple text-based format for the network. It's easy to read.
+# Every command (and every line of a batch) ends with a newline.
 # Put: "PUT <key> <value>\n"
 # Read: "READ <key>\n"
 # Delete: "DELETE <key>\n"
@@ -27,305 +48,1079 @@ COMPACTION_THRESHOLD = 0.5  # If half the file is old, overwritten data, I'll cl
 # ReadKeyRange: "READRANGE <start_key> <end_key>\n"
 # Every response will start with "OK" or "ERROR", so you always know what's going on.
 
+# Every entry in the data file starts with a fixed-size header:
+# crc (4 bytes), timestamp (8 bytes), key_size (4 bytes), value_size (4 bytes).
+# The CRC-32 covers everything after it (the rest of the header, the key and the value), so after
+# a crash I can tell a complete entry from one whose pages never all made it to the disk.
+# I compile the formats once instead of having struct parse them on every call.
+ENTRY_HEADER = struct.Struct("!IQII")
+ENTRY_CRC = struct.Struct("!I")
+ENTRY_META = struct.Struct("!QII")  # The part of the header after the CRC
+HEADER_SIZE = ENTRY_HEADER.size
+
+# Stores from before segments existed were one file of entries without the CRC.
+LEGACY_ENTRY_HEADER = struct.Struct("!QII")
+
+# A delete is stored as an entry with this special value (a "tombstone").
+TOMBSTONE = b"DELETED"
+
+# A hint file starts with the inode and size of the segment file it describes, then has one
+# (timestamp, key_size, value_size, file_position) record plus the key for every entry.
+HINT_HEADER = struct.Struct("!QQ")
+HINT_ENTRY = struct.Struct("!QIIQ")
+
+# macOS has no fdatasync, but plain fsync does the job there.
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+def _fsync_dir(directory):
+    """
+    Makes file creations, renames and removals in `directory` durable. fdatasync on a
+    file covers its data, but the name pointing at it lives in the directory.
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _pack_entry(timestamp, key_bytes, value_bytes):
+    """Returns one entry as buffers ready for writev: the CRC, the rest of the header, the key and the value."""
+    meta = ENTRY_META.pack(timestamp, len(key_bytes), len(value_bytes))
+    crc = zlib.crc32(value_bytes, zlib.crc32(key_bytes, zlib.crc32(meta)))
+    return [ENTRY_CRC.pack(crc), meta, key_bytes, value_bytes]
+
+
+def _as_bytes(value):
+    """
+    Values may arrive as str or as bytes that are already UTF-8 encoded. I check that bytes
+    really are UTF-8 before they reach the disk, since READRANGE has to decode them later.
+    """
+    if isinstance(value, bytes):
+        value.decode('utf-8')  # Raises UnicodeDecodeError for anything that isn't valid UTF-8
+        return value
+    return value.encode('utf-8')
+
+
+def _fadvise(fd, advice):
+    """
+    Tells the kernel how I'm about to read a file, e.g. "POSIX_FADV_SEQUENTIAL". It's only
+    a hint, and macOS and Windows don't have posix_fadvise, so there I just skip it.
+    """
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+
+def _writev_all(fd, iov, offset=None):
+    """
+    Writes a list of byte buffers with as few `writev` calls as possible. Big lists
+    get split so no single call goes over IOV_MAX buffers or WRITEV_MAX_BYTES.
+    With an offset I use `pwritev` and write there instead of at the file position.
+    """
+    i = 0
+    while i < len(iov):
+        chunk = []
+        chunk_bytes = 0
+        while i < len(iov) and len(chunk) < IOV_MAX and (not chunk or chunk_bytes + len(iov[i]) <= WRITEV_MAX_BYTES):
+            chunk.append(iov[i])
+            chunk_bytes += len(iov[i])
+            i += 1
+
+        if offset is None:
+            written = os.writev(fd, chunk)
+        else:
+            written = os.pwritev(fd, chunk, offset)
+        if written < chunk_bytes:
+            # A short write is rare for regular files, so I just finish the rest the simple way.
+            rest = memoryview(b"".join(chunk))[written:]
+            while rest:
+                if offset is None:
+                    done = os.write(fd, rest)
+                else:
+                    done = os.pwrite(fd, rest, offset + written)
+                written += done
+                rest = rest[done:]
+        if offset is not None:
+            offset += chunk_bytes
+
+
+class _ReadWriteLock:
+    """
+    A lock that lets any number of readers in at the same time, while a writer gets
+    the place to itself. Once a writer is waiting, new readers queue up behind it so
+    a steady stream of reads can't starve the writes.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+        # Reusable context managers, so taking the lock doesn't build a generator every time.
+        self._read_side = _LockSide(self._acquire_read, self._release_read)
+        self._write_side = _LockSide(self._acquire_write, self._release_write)
+
+    def read_locked(self):
+        return self._read_side
+
+    def write_locked(self):
+        return self._write_side
+
+    def _acquire_read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def _release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def _acquire_write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+
+    def _release_write(self):
+        with self._cond:
+            self._writing = False
+            self._cond.notify_all()
+
+
+class _LockSide:
+    """One side (read or write) of a _ReadWriteLock, usable in a `with` statement."""
+    __slots__ = ("_acquire", "_release")
+
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+
+    def __exit__(self, *exc_info):
+        self._release()
+
+
+class _CommitJob:
+    """One caller's records, waiting for the writer thread to make them durable."""
+    __slots__ = ("records", "seal", "if_exists", "future")
+
+    def __init__(self, records, seal=False, if_exists=False):
+        self.records = records
+        self.seal = seal  # Start a fresh segment once these records are written
+        self.if_exists = if_exists  # A delete: only write it if the key is there, otherwise answer False
+        # The writer resolves this once the records are durable (or sets the error if they can't be).
+        # Blocking callers wait on `result()`; the server awaits it without tying up a thread.
+        self.future = Future()
+
+
+class Segment:
+    """
+    One file of my log. Only the newest segment takes new writes; once it's full
+    I seal it and it never changes again, which is what lets compaction work on
+    it in the background.
+    """
+    __slots__ = ("seg_id", "path", "hint_path", "rfd", "size", "dead")
+
+    def __init__(self, seg_id, path):
+        self.seg_id = seg_id
+        self.path = path
+        self.hint_path = f"{path}.hint"
+        self.rfd = os.open(path, os.O_RDONLY)  # Everyone reads through this with `pread`
+        # Lookups jump all over the file, so readahead would mostly fetch pages nobody asked for.
+        _fadvise(self.rfd, "POSIX_FADV_RANDOM")
+        self.size = 0  # Bytes of complete entries in the file
+        self.dead = 0  # How many of those bytes are overwritten or deleted
+
+    def close(self):
+        os.close(self.rfd)
+
+
 class KeyValueStore:
     """
     This is my persistent Key/Value store. The big idea here is to be
     super fast for writes and not lose data if something goes wrong.
     It's like a notebook where I only ever add new entries. To find the
     most recent entry for a key, I use an index that I keep in memory.
+    The notebook is split into segment files, so old pages can be
+    cleaned up a couple at a time without stopping everything else.
     """
     def __init__(self):
-        self.data_file = DATA_FILE
-        self.lock = threading.Lock() # I need this lock because multiple clients will be accessing me at once.
-        self.keys = OrderedDict()  # This is my in-memory index: key -> (file_position, entry_size, timestamp)
-        self.data_size = 0  # Total size of all the data in the file
+        self.data_file = DATA_FILE  # Segment files are named "<data_file>.<segment id>"
+        self.directory = os.path.dirname(self.data_file) or "."
+        self.lock = _ReadWriteLock() # Lots of clients can read at once, but changing the index needs it to myself.
+        self.keys = SortedDict()  # This is my in-memory index, kept in key order: key -> (segment, file_position, entry_size, timestamp)
+        self.segments = []  # Oldest first. The last one is the active segment that takes new writes.
+        self.data_size = 0  # Total size of all the data in the segments
         self.deleted_size = 0  # Size of entries that have been overwritten or deleted (the garbage)
+        self._last_compact_size = 0  # data_size right after the last cleanup finished
+        self._cache = OrderedDict()  # Hot values, least recently used first: key -> (value, entry_size)
+        self._cache_lock = threading.Lock() # Readers share self.lock, but they all reorder the cache, so it gets its own.
+        self._cache_bytes = 0
         self._load_from_disk()
+        self._open_active_segment()
+
+        self._commit_queue = queue.Queue()
+        self._writer = threading.Thread(target=self._commit_loop, daemon=True)
+        self._writer.start()
+
+        self._compacting = False  # Set by the writer when it asks for a compaction, cleared when it's done
+        self._compaction_lock = threading.Lock()
+        self._compaction_wanted = threading.Event()
+        self._closing = False
+        self._compactor = threading.Thread(target=self._compaction_loop, daemon=True)
+        self._compactor.start()
+
+    def _segment_path(self, seg_id):
+        return f"{self.data_file}.{seg_id:06d}"
+
+    def _open_active_segment(self):
+        """
+        I keep one write file descriptor open on the active segment, so a write is a
+        single `pwritev` at the end of its data instead of an open, three writes and a close.
+        """
+        if not self.segments:
+            self.segments.append(self._create_segment(1))
+        self._active = self.segments[-1]
+        self._wfd = os.open(self._active.path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self._allocated = self._active.size # How far the file has been preallocated
+
+    def _preallocate(self, end):
+        """
+        Reserves disk space ahead of my writes in PREALLOCATE_CHUNK steps, so the file
+        stays in a few big contiguous extents instead of growing a few bytes at a time.
+        The file's size only changes once per chunk, which also keeps fdatasync cheap.
+        The unused, zero-filled tail gets cut off when the segment is sealed or closed.
+        """
+        if end <= self._allocated or not hasattr(os, "posix_fallocate"):
+            return
+        grow = -(-(end - self._allocated) // PREALLOCATE_CHUNK) * PREALLOCATE_CHUNK
+        try:
+            os.posix_fallocate(self._wfd, self._allocated, grow)
+        except OSError:
+            return # Just a layout optimization. The writes work fine without it.
+        self._allocated += grow
+
+    def _trim_active_segment(self):
+        """Cuts the preallocated space off the end of the active segment. Only the writer thread (or close) calls this."""
+        if self._allocated > self._active.size:
+            os.ftruncate(self._wfd, self._active.size)
+            self._allocated = self._active.size
+
+    def _create_segment(self, seg_id):
+        path = self._segment_path(seg_id)
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o644))
+        # Writes to this segment get fdatasync'd, but that doesn't cover its directory entry.
+        _fsync_dir(self.directory)
+        return Segment(seg_id, path)
+
+    def _roll_segment(self):
+        """Seals the active segment and starts appending to a brand new one. Only the writer thread calls this."""
+        # Everything that can fail happens before I touch self.segments, so a failed
+        # roll leaves the old segment active and the next group simply tries again.
+        segment = self._create_segment(self._active.seg_id + 1)
+        try:
+            wfd = os.open(segment.path, os.O_WRONLY)
+        except BaseException:
+            segment.close()
+            raise
+        try:
+            self._trim_active_segment()
+        except BaseException:
+            os.close(wfd)
+            segment.close()
+            raise
+        with self.lock.write_locked():
+            self.segments.append(segment)
+        old_wfd = self._wfd
+        self._wfd = wfd
+        self._active = segment
+        self._allocated = 0
+        os.close(old_wfd)
+
+    def close(self):
+        """Lets the writer thread finish what's queued, stops compaction, then releases my file descriptors."""
+        self._commit_queue.put(None)
+        self._writer.join()
+        self._closing = True
+        self._compaction_wanted.set()
+        self._compactor.join()
+        with self.lock.write_locked():
+            if self._wfd is not None:
+                self._trim_active_segment()
+                os.close(self._wfd)
+                self._wfd = None
+                for segment in self.segments:
+                    segment.close()
 
     def _load_from_disk(self):
         """
         When I first start up, I have to rebuild my index. I do this by
-        reading through the entire data file, entry by entry, and making
+        reading through every segment, oldest first, entry by entry, and making
         sure my in-memory index points to the very last value I saw for each key.
         This is my crash recovery plan!
         """
-        print("Rebuilding my index from the data file...")
+        print("Rebuilding my index from the data files...")
         self.keys.clear()
+        self.segments = []
         self.data_size = 0
         self.deleted_size = 0
-        
-        if not os.path.exists(self.data_file):
-            print("No data file found. I'll create one when you give me some data to save.")
+
+        if os.path.exists(self.data_file):
+            self._migrate_legacy_store()
+
+        prefix = os.path.basename(self.data_file) + "."
+        seg_ids = sorted(
+            int(name[len(prefix):]) for name in os.listdir(self.directory)
+            if name.startswith(prefix) and name[len(prefix):].isdigit()
+        )
+        if not seg_ids:
+            print("No data files found. I'll create one when you give me some data to save.")
             return
 
-        with open(self.data_file, 'rb') as f:
+        for seg_id in seg_ids:
+            segment = Segment(seg_id, self._segment_path(seg_id))
+            self.segments.append(segment)
+            stat = os.fstat(segment.rfd)
+            file_size = stat.st_size
+            # If compaction left me a hint file, it covers the start of the segment
+            # and I only have to scan whatever comes after it.
+            pos = self._load_hint(segment, stat.st_ino, file_size)
+            if pos < file_size:
+                # I map the file into memory and walk it by offset. The OS streams it in
+                # for me and I never copy a value just to skip over it.
+                _fadvise(segment.rfd, "POSIX_FADV_SEQUENTIAL")
+                with mmap.mmap(segment.rfd, 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, "madvise"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    pos = self._scan_entries(segment, mm, pos, file_size)
+                # I won't look at most of those pages again, so the page cache can have them back.
+                _fadvise(segment.rfd, "POSIX_FADV_DONTNEED")
+                _fadvise(segment.rfd, "POSIX_FADV_RANDOM")
+
+            if pos < file_size:
+                # Chop off the torn (or preallocated) tail so new entries don't get appended after garbage.
+                print(f"Dropping {file_size - pos} unused or incomplete bytes at the end of {segment.path}.")
+                os.truncate(segment.path, pos)
+        print(f"Index rebuilt. I found {len(self.keys)} keys in {len(self.segments)} segments, {self.data_size} bytes in all.")
+
+    def _migrate_legacy_store(self):
+        """
+        A store from before segments existed is one file whose entries have no CRC.
+        I copy its complete entries, with CRCs added, into my first segment. The old
+        file only goes away once the copy is safely on disk.
+        """
+        print("Found an old single-file store. Copying it into my first segment.")
+        new_file = f"{self._segment_path(1)}.tmp"
+        with open(self.data_file, 'rb') as old_f, open(new_file, 'wb') as new_f:
             while True:
-                pos = f.tell() # Remember where I am in the file
+                header = old_f.read(LEGACY_ENTRY_HEADER.size)
+                if len(header) < LEGACY_ENTRY_HEADER.size:
+                    break
+                timestamp, key_size, value_size = LEGACY_ENTRY_HEADER.unpack(header)
+                key_bytes = old_f.read(key_size)
+                value_bytes = old_f.read(value_size)
+                if len(key_bytes) < key_size or len(value_bytes) < value_size:
+                    break # A half-written entry from a crash. It never made it, so I stop here.
+                new_f.write(b"".join(_pack_entry(timestamp, key_bytes, value_bytes)))
+            new_f.flush()
+            _fdatasync(new_f.fileno())
+        os.replace(new_file, self._segment_path(1))
+        _fsync_dir(self.directory)
+        os.remove(self.data_file)
+        if os.path.exists(f"{self.data_file}.hint"):
+            os.remove(f"{self.data_file}.hint")
+
+    def _index_entry(self, key, segment, pos, entry_size, timestamp):
+        """Points my index at a new entry for `key` and counts whatever it replaces as garbage. Needs the write lock."""
+        old = self.keys.get(key)
+        if old is not None:
+            # If this key existed before, its old entry is now just garbage.
+            old_segment, _, old_size, _ = old
+            old_segment.dead += old_size
+            self.deleted_size += old_size
+        self.keys[key] = (segment, pos, entry_size, timestamp)
+        segment.size += entry_size
+        self.data_size += entry_size
+
+    def _scan_entries(self, segment, mm, pos, file_size):
+        """Adds every entry of a segment from `pos` onwards to my index and returns where the last complete one ends."""
+        with memoryview(mm) as view:
+            while pos + HEADER_SIZE <= file_size:
                 # Every entry starts with a fixed-size header:
-                # timestamp (8 bytes), key_size (4 bytes), value_size (4 bytes)
-                header = f.read(16)
-                if not header:
+                # crc (4 bytes), timestamp (8 bytes), key_size (4 bytes), value_size (4 bytes)
+                crc, timestamp, key_size, value_size = ENTRY_HEADER.unpack_from(mm, pos)
+                if timestamp == 0:
+                    break # Zero-filled space I preallocated but never wrote. The data ends here.
+                entry_size = HEADER_SIZE + key_size + value_size
+                if pos + entry_size > file_size:
+                    break # A half-written entry from a crash. It never made it, so I stop here.
+                # With preallocation the file is always long enough, so the size check above can't
+                # catch an entry whose pages only partly reached the disk. The CRC can.
+                if zlib.crc32(view[pos + ENTRY_CRC.size:pos + entry_size]) != crc:
                     break
-                
-                timestamp, key_size, value_size = struct.unpack("!QII", header)
-                key = f.read(key_size).decode('utf-8')
-                value = f.read(value_size) # I don't need to save the value in memory, just its location
-                
-                entry_size = 16 + key_size + value_size
-                if key in self.keys:
-                    old_pos, old_size, _ = self.keys[key]
-                    self.deleted_size += old_size # If I see a key again, its old data is now garbage
-                
-                self.keys[key] = (pos, entry_size, timestamp)
-                self.data_size += entry_size
-        print(f"Index rebuilt. I found {len(self.keys)} keys. My data file is {self.data_size} bytes big.")
-
-    def _compact(self):
-        """
-        This function is my cleanup crew. It's time to get rid of all the old,
-        overwritten data. I'll create a brand new file and just copy over
-        the most recent entry for each key. This reclaims a lot of space.
-        """
-        print("Starting a compaction process to clean up the data file...")
-        new_file = f"{self.data_file}.tmp"
-        with open(self.data_file, 'rb') as old_f, open(new_file, 'wb') as new_f:
-            for key, (pos, size, timestamp) in self.keys.items():
-                old_f.seek(pos)
-                entry_data = old_f.read(size)
-                
-                new_pos = new_f.tell()
-                new_f.write(entry_data)
-                
-                # After moving the data, I have to update my in-memory index to the new location.
-                self.keys[key] = (new_pos, size, timestamp)
-
-        os.replace(new_file, self.data_file)
-        self.deleted_size = 0
-        self.data_size = os.path.getsize(self.data_file)
-        print("Compaction finished. The file is much smaller now.")
 
-    def put(self, key, value):
-        """Adds or updates a key-value pair. It's just a quick append to the end of the file."""
-        with self.lock:
-            # First, check if it's time to do some house-cleaning
-            if self.data_size > 0 and self.deleted_size / self.data_size > COMPACTION_THRESHOLD:
+                key = mm[pos + HEADER_SIZE:pos + HEADER_SIZE + key_size].decode('utf-8')
+                self._index_entry(key, segment, pos, entry_size, timestamp)
+                pos += entry_size
+        return pos
+
+    def _load_hint(self, segment, data_inode, file_size):
+        """
+        Fills my index from a segment's hint file and returns how many bytes of the segment it covers.
+        A hint only counts if it was written for this exact file; otherwise I return 0
+        and the whole segment gets scanned.
+        """
+        try:
+            with open(segment.hint_path, 'rb') as f:
+                hint = f.read()
+        except FileNotFoundError:
+            return 0
+        if len(hint) < HINT_HEADER.size:
+            return 0
+        hint_inode, covered_size = HINT_HEADER.unpack_from(hint)
+        if hint_inode != data_inode or covered_size > file_size:
+            return 0
+
+        # I parse the whole hint before touching my index. It's only a shortcut, so if any of it
+        # is cut short or garbled I forget about it and scan the segment instead.
+        entries = []
+        pos = HINT_HEADER.size
+        try:
+            while pos < len(hint):
+                if pos + HINT_ENTRY.size > len(hint):
+                    raise ValueError("record cut short")
+                timestamp, key_size, value_size, entry_pos = HINT_ENTRY.unpack_from(hint, pos)
+                pos += HINT_ENTRY.size
+                entry_size = HEADER_SIZE + key_size + value_size
+                if pos + key_size > len(hint) or entry_pos + entry_size > covered_size:
+                    raise ValueError("record out of bounds")
+                key = hint[pos:pos + key_size].decode('utf-8')
+                pos += key_size
+                entries.append((key, entry_pos, entry_size, timestamp))
+        except ValueError as e: # UnicodeDecodeError is a ValueError too
+            print(f"Ignoring {segment.hint_path} ({e}). I'll scan the segment instead.")
+            return 0
+
+        for key, entry_pos, entry_size, timestamp in entries:
+            self._index_entry(key, segment, entry_pos, entry_size, timestamp)
+        print(f"Loaded {len(entries)} keys from {segment.hint_path}.")
+        return covered_size
+
+    def _write_hint(self, segment, entries):
+        """
+        A freshly merged segment holds exactly one entry per key, so I write down where
+        each one is. Next startup can read this small file instead of the big one.
+        `entries` is a list of (key_bytes, pos, entry_size, timestamp).
+        """
+        records = [HINT_HEADER.pack(os.fstat(segment.rfd).st_ino, segment.size)]
+        for key_bytes, pos, size, timestamp in entries:
+            records.append(HINT_ENTRY.pack(timestamp, len(key_bytes), size - HEADER_SIZE - len(key_bytes), pos))
+            records.append(key_bytes)
+
+        new_hint = f"{segment.hint_path}.tmp"
+        with open(new_hint, 'wb') as f:
+            f.write(b"".join(records))
+            f.flush()
+            _fdatasync(f.fileno())
+        os.replace(new_hint, segment.hint_path)
+
+    def compact(self):
+        """Seals the active segment and cleans up every sealed one that has garbage. Blocks until it's done."""
+        self._submit([], seal=True).result()
+        self._compact(everything=True)
+
+    def _compaction_loop(self):
+        """The background cleanup thread. It sleeps until the writer thread says there's enough garbage."""
+        while True:
+            self._compaction_wanted.wait()
+            self._compaction_wanted.clear()
+            if self._closing:
+                return
+            try:
                 self._compact()
-                
-            value_bytes = value.encode('utf-8')
-            key_bytes = key.encode('utf-8')
-            
-            timestamp = int(time.time())
-            key_size = len(key_bytes)
-            value_size = len(value_bytes)
-            
-            # Pack the header into a nice, tidy byte string
-            header = struct.pack("!QII", timestamp, key_size, value_size)
-            
-            with open(self.data_file, 'ab') as f:
-                pos = f.tell() # This is the position where the new entry will start
-                f.write(header)
-                f.write(key_bytes)
-                f.write(value_bytes)
-                
-            entry_size = 16 + key_size + value_size
-            
-            # Now, update my in-memory index.
-            if key in self.keys:
-                # If this key existed before, its old entry is now just garbage.
-                old_pos, old_size, _ = self.keys[key]
-                self.deleted_size += old_size
-            
-            self.keys[key] = (pos, entry_size, timestamp)
-            self.data_size += entry_size
-            return True
+            except Exception as e:
+                # A failed merge (a full disk, say) mustn't stop cleanup for good. The old
+                # segments are untouched, so I just log it and wait for the next signal. Waiting
+                # for more growth first keeps me from retrying after every single write.
+                print(f"Compaction failed, I'll try again later: {e!r}")
+                with self.lock.read_locked():
+                    self._last_compact_size = self.data_size
+            finally:
+                self._compacting = False
+
+    def _compact(self, everything=False):
+        """
+        This function is my cleanup crew. Instead of rewriting everything in one go
+        (and making every client wait), I pick the sealed segment that's mostly garbage,
+        rewrite it with only its live entries, and repeat while there's garbage worth
+        the copying. Segments without much garbage are left alone, so the work tracks
+        the garbage and not the size of the store. Reads and writes carry on the whole
+        time; they only wait for the moment I swap the merged segment in.
+        With `everything`, any sealed segment with any garbage at all gets cleaned.
+        """
+        with self._compaction_lock:
+            with self.lock.read_locked():
+                rounds = len(self.segments) - 1
+            for _ in range(rounds):
+                with self.lock.read_locked():
+                    merging = self._pick_merge(everything)
+                if not merging:
+                    break
+                self._merge(merging)
+            with self.lock.read_locked():
+                self._last_compact_size = self.data_size
+
+    def _pick_merge(self, everything):
+        """
+        Chooses the segments for the next merge: the sealed segment with the most garbage
+        for its size, plus its older neighbour when their live data fits in one segment
+        (so small leftovers don't pile up). Returns [] if nothing is worth it. Needs self.lock.
+        """
+        sealed = self.segments[:-1]
+        candidates = [segment for segment in sealed
+                      if segment.dead and (everything or segment.dead > segment.size >> COMPACTION_THRESHOLD_SHIFT)]
+        if not candidates:
+            return []
+        victim = max(candidates, key=lambda segment: segment.dead / segment.size)
+        i = sealed.index(victim)
+        if i > 0 and (sealed[i - 1].size - sealed[i - 1].dead) + (victim.size - victim.dead) <= SEGMENT_MAX_SIZE:
+            return sealed[i - 1:i + 1]
+        return [victim]
+
+    def _merge(self, merging):
+        """Writes the live entries of some neighbouring sealed segments into one new segment and swaps it in."""
+        print(f"Merging segments {[segment.seg_id for segment in merging]}...")
+
+        # First find every entry in these files. They're sealed, so nothing can change them under me.
+        found = []
+        for segment in merging:
+            if segment.size == 0:
+                continue # Can't map an empty file, and there's nothing in it to keep anyway
+            # From here on these files are only read front to back, and they're gone after the merge.
+            _fadvise(segment.rfd, "POSIX_FADV_SEQUENTIAL")
+            with mmap.mmap(segment.rfd, 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                pos = 0
+                while pos < segment.size:
+                    _, timestamp, key_size, value_size = ENTRY_HEADER.unpack_from(mm, pos)
+                    entry_size = HEADER_SIZE + key_size + value_size
+                    key_bytes = mm[pos + HEADER_SIZE:pos + HEADER_SIZE + key_size]
+                    is_tombstone = value_size == len(TOMBSTONE) and mm[pos + HEADER_SIZE + key_size:pos + entry_size] == TOMBSTONE
+                    found.append((segment, pos, entry_size, timestamp, key_bytes, is_tombstone))
+                    pos += entry_size
+
+        # Only the entries my index still points at are worth keeping.
+        with self.lock.read_locked():
+            # A tombstone can only go once no older segment could still hold a value it hides,
+            # which is when the merge starts at the oldest segment. Otherwise it's copied like any entry.
+            drop_tombstones = merging[0] is self.segments[0]
+            live = []
+            for segment, pos, entry_size, timestamp, key_bytes, is_tombstone in found:
+                current = self.keys.get(key_bytes.decode('utf-8'))
+                if current is not None and current[0] is segment and current[1] == pos:
+                    live.append((segment, pos, entry_size, timestamp, key_bytes, is_tombstone))
+
+        new_file = f"{merging[0].path}.tmp"
+        copied = []
+        # `live` is already in file order (I scanned each segment front to back), so I can read
+        # neighbouring entries with one pread and hand the slices to writev in big batches.
+        kept = [entry for entry in live if not (drop_tombstones and entry[5])]
+        fd = os.open(new_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            new_pos = 0
+            iov = []
+            buffered = 0
+            i = 0
+            while i < len(kept):
+                segment = kept[i][0]
+                run_start = kept[i][1]
+                run_end = run_start + kept[i][2]
+                j = i + 1
+                while (j < len(kept) and kept[j][0] is segment
+                       and kept[j][1] - run_end <= RANGE_READ_MAX_GAP
+                       and kept[j][1] + kept[j][2] - run_start <= MERGE_BUFFER_SIZE):
+                    run_end = kept[j][1] + kept[j][2]
+                    j += 1
+
+                run = memoryview(os.pread(segment.rfd, run_end - run_start, run_start))
+                for segment, pos, entry_size, timestamp, key_bytes, _ in kept[i:j]:
+                    iov.append(run[pos - run_start:pos - run_start + entry_size])
+                    copied.append((segment, pos, key_bytes, new_pos, entry_size, timestamp))
+                    new_pos += entry_size
+                buffered += run_end - run_start
+                if buffered >= MERGE_BUFFER_SIZE:
+                    _writev_all(fd, iov)
+                    iov = []
+                    buffered = 0
+                i = j
+            _writev_all(fd, iov)
+
+            # The new file has to be durable before it takes the old ones' place.
+            _fdatasync(fd)
+            os.close(fd)
+            fd = None
+
+            # The merged file keeps the oldest segment's name, so segments stay in order on disk.
+            os.replace(new_file, merging[0].path)
+        except BaseException:
+            # The old segments are still all there, so a half-written copy is just litter.
+            if fd is not None:
+                os.close(fd)
+            if os.path.exists(new_file):
+                os.remove(new_file)
+            raise
+        # The rename has to be on disk before I remove the merged-away segments. Otherwise a
+        # crash could bring back the old first segment with the others (and their live entries) gone.
+        _fsync_dir(self.directory)
+        merged = Segment(merging[0].seg_id, merging[0].path)
+
+        with self.lock.write_locked():
+            for segment, pos, key_bytes, new_pos, entry_size, timestamp in copied:
+                key = key_bytes.decode('utf-8')
+                current = self.keys.get(key)
+                if current is not None and current[0] is segment and current[1] == pos:
+                    self.keys[key] = (merged, new_pos, entry_size, timestamp)
+                else:
+                    merged.dead += entry_size # Someone overwrote it while I was copying
+                merged.size += entry_size
+
+            for segment, pos, entry_size, timestamp, key_bytes, is_tombstone in live:
+                if drop_tombstones and is_tombstone:
+                    key = key_bytes.decode('utf-8')
+                    current = self.keys.get(key)
+                    if current is not None and current[0] is segment and current[1] == pos:
+                        del self.keys[key]
+
+            self.data_size += merged.size - sum(segment.size for segment in merging)
+            self.deleted_size += merged.dead - sum(segment.dead for segment in merging)
+            start = self.segments.index(merging[0])
+            self.segments[start:start + len(merging)] = [merged]
+            for segment in merging:
+                _fadvise(segment.rfd, "POSIX_FADV_DONTNEED")
+                segment.close()
+
+        for segment in merging[1:]:
+            os.remove(segment.path)
+            if os.path.exists(segment.hint_path):
+                os.remove(segment.hint_path)
+        self._write_hint(merged, [(key_bytes, new_pos, entry_size, timestamp)
+                                  for _, _, key_bytes, new_pos, entry_size, timestamp in copied])
+        print(f"Merge finished. Segment {merged.seg_id} is now {merged.size} bytes.")
+
+    def put(self, key, value):
+        """
+        Adds or updates a key-value pair. It's just a quick append to the end of the file.
+        The value can be a str or bytes that are already UTF-8 encoded.
+        """
+        # Hand it to the writer thread and wait until it's safely on disk.
+        return self.start_put(key, value).result()
+
+    def start_put(self, key, value):
+        """Like `put`, but returns right away with a future that's done once the write is durable."""
+        return self._submit([(key, key.encode('utf-8'), _as_bytes(value))])
 
     def read(self, key):
-        """Reads the value for a given key. It's a two-step process: find the location in memory, then jump to it in the file."""
-        with self.lock:
-            if key not in self.keys:
+        """
+        Reads the value for a given key. It's a two-step process: find the location in memory, then jump to it in the file.
+        The value comes back as raw UTF-8 bytes, ready to go straight onto the network.
+        """
+        # Recently written or read values are kept in memory, so I can skip the disk entirely.
+        # The writer updates the cache together with the index, so a hit doesn't need self.lock.
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached[0]
+
+        with self.lock.read_locked():
+            location = self.keys.get(key)
+            if location is None:
                 return None
             
-            pos, entry_size, _ = self.keys[key]
+            segment, pos, entry_size, _ = location
             
-            with open(self.data_file, 'rb') as f:
-                f.seek(pos) # Jump straight to the right spot
-                header = f.read(16)
-                timestamp, key_size, value_size = struct.unpack("!QII", header)
-                # Skip the key data and go right to the value
-                f.seek(pos + 16 + key_size)
-                value = f.read(value_size).decode('utf-8')
+            # One positional read grabs the whole entry: header, key and value.
+            entry = os.pread(segment.rfd, entry_size, pos)
+            _, timestamp, key_size, value_size = ENTRY_HEADER.unpack_from(entry)
+            # Skip the key data and go right to the value
+            value = entry[HEADER_SIZE + key_size:]
             
             # I use a special "DELETED" value to mark things for removal.
-            if value == "DELETED":
+            if value == TOMBSTONE:
                 return None
+            self._cache_value(key, value, entry_size)
             return value
 
+    def _cache_value(self, key, value, size):
+        """
+        Remembers the latest value for a key (None means it's gone), then throws out the
+        least recently used values until the cache fits in CACHE_MAX_BYTES. Needs self.lock
+        (either side), so the index can't move under me.
+        """
+        with self._cache_lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self._cache_bytes -= old[1]
+            if value is None or size > CACHE_MAX_BYTES:
+                return
+            self._cache[key] = (value, size)
+            self._cache_bytes += size
+            while self._cache_bytes > CACHE_MAX_BYTES:
+                _, (_, evicted_size) = self._cache.popitem(last=False)
+                self._cache_bytes -= evicted_size
+
     def read_key_range(self, start_key, end_key):
         """
         I'll find all the keys and their latest values within a given alphabetical range.
-        This isn't the most efficient thing because I have to sort all the keys first.
+        My index is already sorted, so I can jump straight to the first key in the range.
         """
-        result = []
-        with self.lock:
-            # First, get a list of keys and their file positions while holding the lock
+        with self.lock.read_locked():
+            # First, get a list of keys and their file positions
             keys_to_read = []
-            sorted_keys = sorted(self.keys.keys())
-            
-            for key in sorted_keys:
-                if start_key <= key <= end_key:
-                    # Get the file position and size.
-                    keys_to_read.append((key, self.keys[key][0], self.keys[key][1]))
-
-        # Now, release the lock and read the values from the file
-        with open(self.data_file, 'rb') as f:
-            for key, pos, size in keys_to_read:
-                f.seek(pos)
-                header = f.read(16)
-                timestamp, key_size, value_size = struct.unpack("!QII", header)
-                f.seek(pos + 16 + key_size)
-                value = f.read(value_size).decode('utf-8')
-                if value != "DELETED":
-                    result.append((key, value))
-        return result
+            for key in self.keys.irange(start_key, end_key):
+                # Get the segment, file position and size.
+                segment, pos, size, _ = self.keys[key]
+                keys_to_read.append((key, segment, pos, size))
+
+            # Now read the values in file order. Entries that sit next to each other
+            # (or close enough) in the same segment are grabbed together with a single pread.
+            values = {}
+            by_position = sorted(keys_to_read, key=lambda entry: (entry[1].seg_id, entry[2]))
+            i = 0
+            while i < len(by_position):
+                segment = by_position[i][1]
+                run_start = by_position[i][2]
+                run_end = run_start + by_position[i][3]
+                j = i + 1
+                while (j < len(by_position) and by_position[j][1] is segment
+                       and by_position[j][2] - run_end <= RANGE_READ_MAX_GAP):
+                    run_end = by_position[j][2] + by_position[j][3]
+                    j += 1
+
+                run = memoryview(os.pread(segment.rfd, run_end - run_start, run_start))
+                for key, _, pos, size in by_position[i:j]:
+                    offset = pos - run_start
+                    _, timestamp, key_size, value_size = ENTRY_HEADER.unpack_from(run, offset)
+                    values[key] = run[offset + HEADER_SIZE + key_size:offset + size]
+                i = j
+
+        # Values stay as memoryview slices until here; I only decode the ones I actually return.
+        return [(key, str(values[key], 'utf-8')) for key, _, _, _ in keys_to_read
+                if values[key] != TOMBSTONE]
 
     def batch_put(self, items):
         """
         Adds a bunch of key-value pairs at once. This is way faster than calling `put`
-        over and over because I can just do one big file append.
+        over and over because the whole batch goes to disk in one vectored write.
         """
-        with self.lock:
-            if self.data_size > 0 and self.deleted_size / self.data_size > COMPACTION_THRESHOLD:
-                self._compact()
-            
-            with open(self.data_file, 'ab') as f:
-                for key, value in items.items():
-                    value_bytes = value.encode('utf-8')
-                    key_bytes = key.encode('utf-8')
-                    
-                    timestamp = int(time.time())
-                    key_size = len(key_bytes)
-                    value_size = len(value_bytes)
-                    
-                    header = struct.pack("!QII", timestamp, key_size, value_size)
-                    pos = f.tell()
-                    
-                    f.write(header)
-                    f.write(key_bytes)
-                    f.write(value_bytes)
-                    
-                    entry_size = 16 + key_size + value_size
-                    if key in self.keys:
-                        old_pos, old_size, _ = self.keys[key]
-                        self.deleted_size += old_size
-                    
-                    self.keys[key] = (pos, entry_size, timestamp)
-                    self.data_size += entry_size
-            return True
+        return self.start_batch_put(items).result()
+
+    def start_batch_put(self, items):
+        """Like `batch_put`, but returns right away with a future that's done once the batch is durable."""
+        return self._submit([(key, key.encode('utf-8'), _as_bytes(value)) for key, value in items.items()])
 
     def delete(self, key):
         """
         I delete a key by writing a special "tombstone" entry. It's basically a `put`
         with a value of "DELETED". The old data will be cleaned up during the next compaction run.
         """
-        with self.lock:
-            # Check if the key exists before trying to delete it
-            if key not in self.keys:
-                return False
+        return self.start_delete(key).result()
+
+    def start_delete(self, key):
+        """
+        Like `delete`, but returns right away with a future. Its result is False if the key wasn't there.
+        The writer thread checks that, so this never waits on self.lock (the server calls it from its event loop).
+        """
+        return self._submit([(key, key.encode('utf-8'), TOMBSTONE)], if_exists=True)
+
+    def _submit(self, records, seal=False, if_exists=False):
+        """
+        Queues some records for the writer thread and returns the future it will resolve
+        (with True) once they're durable. Each record is (key, key_bytes, value_bytes).
+        """
+        job = _CommitJob(records, seal, if_exists)
+        self._commit_queue.put(job)
+        return job.future
 
-            value_bytes = "DELETED".encode('utf-8')
-            key_bytes = key.encode('utf-8')
+    def _commit_loop(self):
+        """
+        This is my group commit. Calling fdatasync for every single put would be
+        painfully slow, so one writer thread does all the writing. While it waits on
+        the disk, new requests pile up in the queue, and the next round writes all
+        of them with one writev and makes them durable with one fdatasync.
+        """
+        while True:
+            job = self._commit_queue.get()
+            if job is None:
+                return
+            jobs = [job]
+            stopping = False
+            while len(jobs) < GROUP_COMMIT_MAX_JOBS:
+                try:
+                    job = self._commit_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                jobs.append(job)
 
-            timestamp = int(time.time())
-            key_size = len(key_bytes)
-            value_size = len(value_bytes)
+            try:
+                self._write_group(jobs)
+            except BaseException as e:
+                # Whatever went wrong, the writer has to stay alive, or every put from now on
+                # would wait forever. Whoever hasn't been answered yet gets the error.
+                print(f"Writing a group of {len(jobs)} commits failed: {e!r}")
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+            if stopping:
+                return
 
-            header = struct.pack("!QII", timestamp, key_size, value_size)
-            
-            with open(self.data_file, 'ab') as f:
-                pos = f.tell()
-                f.write(header)
-                f.write(key_bytes)
-                f.write(value_bytes)
+    def _drop_missing_deletes(self, jobs):
+        """
+        Answers False to every delete whose key doesn't exist, and returns the jobs that still
+        need writing. A key written earlier in this same group counts as existing.
+        """
+        written = set()
+        kept = []
+        with self.lock.read_locked():
+            for job in jobs:
+                if job.if_exists:
+                    key = job.records[0][0]
+                    if key not in written and key not in self.keys:
+                        job.future.set_result(False)
+                        continue
+                for key, _, _ in job.records:
+                    written.add(key)
+                kept.append(job)
+        return kept
 
-            entry_size = 16 + key_size + value_size
-            
-            # Now, update my in-memory index.
-            if key in self.keys:
-                old_pos, old_size, _ = self.keys[key]
-                self.deleted_size += old_size
-            
-            self.keys[key] = (pos, entry_size, timestamp)
-            self.data_size += entry_size
-            
-            # Since we just added a tombstone, we may need to compact
-            if self.data_size > 0 and self.deleted_size / self.data_size > COMPACTION_THRESHOLD:
-                self._compact()
-            
-            return True
+    def _write_group(self, jobs):
+        if any(job.if_exists for job in jobs):
+            jobs = self._drop_missing_deletes(jobs)
+            if not jobs:
+                return
 
+        if self._active.size >= SEGMENT_MAX_SIZE:
+            self._roll_segment()
 
-class ThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
-    def handle(self):
-        # A new thread is created for each client, so I can handle multiple clients at once.
-        data = self.request.recv(1024).decode('utf-8').strip()
-        
-        # Cleanly stop the server for testing
-        if data == "SHUTDOWN":
-            self.server.shutdown()
-            self.request.sendall(b"OK\n")
+        # The clock is read once for the whole group rather than once per record.
+        # Timestamps only have one-second resolution anyway.
+        timestamp = int(time.time())
+        iov = []
+        for job in jobs:
+            for key, key_bytes, value_bytes in job.records:
+                iov += _pack_entry(timestamp, key_bytes, value_bytes)
+        try:
+            self._preallocate(self._active.size + sum(len(buf) for buf in iov))
+            _writev_all(self._wfd, iov, self._active.size)
+            _fdatasync(self._wfd)
+        except OSError as e:
+            # Nobody in this group made it to disk, so they all get the error. I also cut
+            # off anything that did get written, so the file ends where my index thinks it does.
+            try:
+                os.ftruncate(self._wfd, self._active.size)
+                self._allocated = self._active.size
+            except OSError:
+                pass
+            for job in jobs:
+                job.future.set_exception(e)
             return
 
-        command, *args = data.split(' ', 1)
-        
-        store = self.server.store
-        response = ""
+        with self.lock.write_locked():
+            # The data is on disk, so now it's safe to point my index at it.
+            segment = self._active
+            pos = segment.size
+            for job in jobs:
+                for key, key_bytes, value_bytes in job.records:
+                    entry_size = HEADER_SIZE + len(key_bytes) + len(value_bytes)
+                    self._index_entry(key, segment, pos, entry_size, timestamp)
+                    self._cache_value(key, None if value_bytes == TOMBSTONE else value_bytes, entry_size)
+                    pos += entry_size
+            # All integer maths, and only once the store has grown enough since the last cleanup.
+            needs_compaction = (not self._compacting
+                                and self.data_size - self._last_compact_size > COMPACTION_MIN_GROWTH
+                                and self.deleted_size > self.data_size >> COMPACTION_THRESHOLD_SHIFT)
+            if needs_compaction:
+                self._compacting = True
+
+        # Everyone's records are durable and indexed, so they get their answer now. Only
+        # seal requests wait for the roll below, since that's what they asked for.
+        for job in jobs:
+            if not job.seal:
+                job.future.set_result(True)
 
         try:
-            print(f"Received command: {command} with args: {args}")
-            if command == "PUT":
-                key, value = args[0].split(' ', 1)
-                store.put(key, value)
-                response = f"OK\n"
-            elif command == "READ":
-                key = args[0]
-                value = store.read(key)
-                response = f"OK {value}\n" if value is not None else "OK NULL\n"
-            elif command == "DELETE":
-                key = args[0]
-                if store.delete(key):
-                    response = "OK\n"
-                else:
-                    response = "ERROR Key not found\n"
-            elif command == "READRANGE":
-                start_key, end_key = args[0].split(' ', 1)
-                results = store.read_key_range(start_key, end_key)
-                response = "OK " + json.dumps(results) + "\n"
-            elif command == "BATCHPUT":
-                # This part is a placeholder. For a real system, I'd need to handle
-                # multi-line input more carefully.
-                pass
-            else:
-                response = "ERROR Invalid command\n"
-        except Exception as e:
-            response = f"ERROR {e}\n"
+            # Compaction only touches sealed segments, so if the garbage is in the active one I seal it first.
+            if any(job.seal for job in jobs) or (needs_compaction and self._active.dead):
+                if self._active.size:
+                    self._roll_segment()
         finally:
-            self.request.sendall(response.encode('utf-8'))
+            # Even if the roll failed, the cleanup thread can still work on what's already sealed
+            # (and it's the one that clears self._compacting again).
+            if needs_compaction:
+                self._compaction_wanted.set()
+
+        for job in jobs:
+            if job.seal:
+                job.future.set_result(True)
 
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    def __init__(self, server_address, RequestHandlerClass, store):
-        super().__init__(server_address, RequestHandlerClass)
+
+class KeyValueServer:
+    """
+    The network side. One asyncio event loop juggles every client connection, so an
+    idle client costs me almost nothing and I never start a thread per connection.
+    Writes are queued for the store's writer thread and awaited as futures, so a
+    client waiting on fdatasync doesn't hold a thread. Reads block on the disk,
+    so they run on a small thread pool while the loop keeps serving everyone else.
+    """
+    def __init__(self, server_address, store):
         self.store = store
-        self.daemon_threads = True
+        # I bind right away, like socketserver does, so port 0 works and the address is known up front.
+        self.socket = socket.create_server(server_address)
+        self.server_address = self.socket.getsockname()
+        self._executor = ThreadPoolExecutor(max_workers=WORKER_THREADS)
+        self._loop = None
+        self._stop = None
+        self._running = threading.Event()
+        self._stopped = threading.Event()
+
+    def serve_forever(self):
+        """Runs the event loop in this thread until `shutdown` is called (or a client sends SHUTDOWN)."""
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        server = await asyncio.start_server(self._handle, sock=self.socket, limit=MAX_LINE_SIZE)
+        self._running.set()
+        try:
+            async with server:
+                await self._stop.wait()
+        finally:
+            self._stopped.set()
+
+    def shutdown(self):
+        """Stops `serve_forever` from another thread and waits until it has."""
+        self._running.wait()
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+        self._executor.shutdown(wait=False)
+
+    async def _handle(self, reader, writer):
+        # A client can keep its connection open and send as many commands as it likes.
+        try:
+            while True:
+                line = await self._readline(reader)
+                if line is None:
+                    return
+                # I work on the raw bytes. Only keys get decoded; values go to disk as they came in.
+                data = line.strip()
+                if not data:
+                    continue
+
+                # Cleanly stop the server for testing
+                if data == b"SHUTDOWN":
+                    writer.write(b"OK\n")
+                    await writer.drain()
+                    self._stop.set()
+                    return
+
+                response = await self._run_command(data, reader)
+                # The pieces go out together, without first gluing them into one string.
+                writer.writelines(response)
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError) as e:
+            # LimitOverrunError means a line went over MAX_LINE_SIZE.
+            print(f"Dropping a client connection: {e}")
+        except asyncio.CancelledError:
+            # The server is shutting down with this client still connected. I end the handler
+            # quietly, since asyncio 3.11 logs a cancelled connection task as an unhandled error.
+            pass
+        finally:
+            writer.close()
+
+    async def _readline(self, reader):
+        """Returns the next line, or None once the client has hung up. A last line without a newline still counts."""
+        try:
+            return await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            return e.partial or None
+
+    async def _call_store(self, method, *args):
+        return await self._loop.run_in_executor(self._executor, method, *args)
+
+    async def _run_command(self, data, reader):
+        command, *args = data.split(b' ', 1)
+        
+        store = self.store
+
+        try:
+            print(f"Received command: {command.decode('utf-8', 'replace')}")
+            if command == b"PUT":
+                key, value = args[0].split(b' ', 1)
+                await asyncio.wrap_future(store.start_put(key.decode('utf-8'), value))
+                return [b"OK\n"]
+            elif command == b"READ":
+                key = args[0].decode('utf-8')
+                value = await self._call_store(store.read, key)
+                if value is None:
+                    return [b"OK NULL\n"]
+                return [b"OK ", value, b"\n"]
+            elif command == b"DELETE":
+                key = args[0].decode('utf-8')
+                if await asyncio.wrap_future(store.start_delete(key)):
+                    return [b"OK\n"]
+                return [b"ERROR Key not found\n"]
+            elif command == b"READRANGE":
+                start_key, end_key = args[0].decode('utf-8').split(' ', 1)
+                results = await self._call_store(store.read_key_range, start_key, end_key)
+                # orjson writes the UTF-8 bytes straight out, so there's no str to re-encode afterwards.
+                return [b"OK ", orjson.dumps(results), b"\n"]
+            elif command == b"BATCHPUT":
+                # The header line tells me how many "<key> <value>" lines follow it.
+                num_items = int(args[0])
+                # I read every line of the batch before parsing any of them. If one turns out to be
+                # bad, the rest are already consumed and can't be mistaken for commands of their own.
+                lines = []
+                for _ in range(num_items):
+                    item = await self._readline(reader)
+                    if item is None:
+                        return [b"ERROR Batch ended early\n"]
+                    lines.append(item)
+                items = {}
+                for item in lines:
+                    key, value = item.strip().split(b' ', 1)
+                    items[key.decode('utf-8')] = value
+                await asyncio.wrap_future(store.start_batch_put(items))
+                return [b"OK\n"]
+            else:
+                return [b"ERROR Invalid command\n"]
+        except Exception as e:
+            return [f"ERROR {e}\n".encode('utf-8')]
 
 if __name__ == '__main__':
     # This block ensures that the server runs only when this script is executed directly.
     # It will not run when the file is imported as a module in another script, like server_tests.py.
     print("Starting the server...")
     kv_store = KeyValueStore()
-    server = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler, kv_store)
+    server = KeyValueServer((HOST, PORT), kv_store)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print("Server shut down.")
     finally:
         server.server_close()
+        kv_store.close()
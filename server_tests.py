@@ -2,7 +2,8 @@ import socket
 import threading
 import time
 import json
-from server import ThreadedTCPServer, ThreadedTCPRequestHandler, KeyValueStore, HOST, PORT
+import server as server_module
+from server import KeyValueServer, KeyValueStore, HOST, PORT, _pack_entry
 
 def find_free_port():
     """
@@ -19,7 +20,7 @@ def send_command(port, command):
         # A new socket is created to handle the connection for each command.
         try:
             sock.connect((HOST, port))
-            sock.sendall(command.encode('utf-8'))
+            sock.sendall((command + "\n").encode('utf-8'))
             received = str(sock.recv(1024), "utf-8")
             return received.strip()
         except Exception as e:
@@ -27,6 +28,15 @@ def send_command(port, command):
             # We can ignore this, as it's part of the shutdown process.
             return f"ERROR: {e}"
 
+def check_store(store, expected):
+    """Checks every key in `expected` (None means deleted) with READ, and all of them together with READRANGE."""
+    for key, value in expected.items():
+        got = store.read(key)
+        assert got == value, f"Expected {value!r} for '{key}', got {got!r}"
+    live = sorted((key, value.decode("utf-8")) for key, value in expected.items() if value is not None)
+    got = store.read_key_range(min(expected), max(expected))
+    assert got == live, f"Expected READRANGE to return {len(live)} live keys, got {len(got)}"
+
 def run_tests():
     """
     This function runs all the tests in a simple, sequential manner.
@@ -38,9 +48,10 @@ def run_tests():
     # 1. Start the server on a new thread with a free port
     port = find_free_port()
     kv_store = KeyValueStore()
-    server = ThreadedTCPServer((HOST, port), ThreadedTCPRequestHandler, kv_store)
+    server = KeyValueServer((HOST, port), kv_store)
     server_thread = threading.Thread(target=server.serve_forever, daemon=True)
     server_thread.start()
+    server_running = True
 
     # Wait for the server to be ready
     time.sleep(1) # a simple sleep is sufficient for this simple test
@@ -97,6 +108,140 @@ def run_tests():
         assert results == expected_results, f"Expected {expected_results}, got {results}"
         print("Test 5: READRANGE passed.")
 
+        # Test BATCHPUT, including a value too big for a single recv
+        print("Test 6: BATCHPUT.")
+        big_value = "x" * 100000
+        response = send_command(port, f"BATCHPUT 3\nbatch_a value_a\nbatch_b value_b\nbatch_big {big_value}")
+        assert response == "OK", f"Expected 'OK', got '{response}'"
+        response = send_command(port, "READ batch_a")
+        assert response == "OK value_a", f"Expected 'OK value_a', got '{response}'"
+        response = send_command(port, "READ batch_b")
+        assert response == "OK value_b", f"Expected 'OK value_b', got '{response}'"
+        assert kv_store.read("batch_big") == big_value.encode("utf-8"), "Expected the big value to survive the trip"
+        print("Test 6: BATCHPUT passed.")
+
+        # Test that a bad line inside a batch can't smuggle the lines after it in as commands
+        print("Test 7: Bad BATCHPUT line.")
+        send_command(port, "PUT victim still_here")
+        with socket.create_connection((HOST, port)) as sock:
+            sock.sendall(b"BATCHPUT 3\nnospace\nDELETE victim\nPUT injected yes\nREAD victim\n")
+            replies = sock.makefile("rb")
+            response = replies.readline().decode("utf-8").strip()
+            assert response.startswith("ERROR"), f"Expected an ERROR for the bad batch, got '{response}'"
+            response = replies.readline().decode("utf-8").strip()
+            assert response == "OK still_here", f"Expected the next reply to be the READ, got '{response}'"
+        response = send_command(port, "READ injected")
+        assert response == "OK NULL", f"Expected 'OK NULL', got '{response}'"
+        print("Test 7: Bad BATCHPUT line passed.")
+
+        # Test that a restart after compaction (which loads the hint file) sees the same data
+        print("Test 8: Restart after compaction.")
+        kv_store.compact()
+        response = send_command(port, "PUT after_compaction tail_value")
+        assert response == "OK", f"Expected 'OK', got '{response}'"
+        # Only one store may own the data files at a time, so the first one shuts down before the restart.
+        server.shutdown()
+        server_thread.join()
+        server.server_close()
+        kv_store.close()
+        server_running = False
+        restarted = KeyValueStore()
+        try:
+            expected_values = {
+                "test_key": b"test_value",
+                "key_to_overwrite": b"new_value",
+                "c_key": b"value_c",
+                "batch_a": b"value_a",
+                "batch_big": big_value.encode("utf-8"),
+                "after_compaction": b"tail_value",
+            }
+            for key, value in expected_values.items():
+                assert restarted.read(key) == value, f"Expected '{key}' to survive a restart"
+            assert restarted.read("key_to_delete") is None, "Expected 'key_to_delete' to stay deleted"
+        finally:
+            restarted.close()
+        print("Test 8: Restart after compaction passed.")
+
+        # Test that a torn write in the preallocated tail doesn't replace the last good value
+        print("Test 9: Torn write after a crash.")
+        torn_store = KeyValueStore()
+        torn_store.put("torn_key", "good")
+        torn_store.close()
+        # Fake an overwrite that a crash cut short: its header and key reached the disk, but its
+        # value pages didn't, so they still hold the zeros posix_fallocate put there.
+        crc, meta, key_bytes, value_bytes = _pack_entry(int(time.time()), b"torn_key", b"v" * 4096)
+        with open(torn_store.segments[-1].path, "ab") as f:
+            f.write(crc + meta + key_bytes + b"\0" * (len(value_bytes) + 4096))
+        restarted = KeyValueStore()
+        try:
+            value = restarted.read("torn_key")
+            assert value == b"good", f"Expected the last good value to survive, got {value[:16]!r}"
+        finally:
+            restarted.close()
+        print("Test 9: Torn write after a crash passed.")
+
+        # Test rolling, background compaction and merges across several small segments
+        print("Test 10: Segments and background compaction.")
+        saved = (server_module.DATA_FILE, server_module.SEGMENT_MAX_SIZE, server_module.COMPACTION_MIN_GROWTH)
+        server_module.DATA_FILE = "segments_test.dat"  # A fresh store, apart from the other tests' files
+        server_module.SEGMENT_MAX_SIZE = 1024  # About a dozen entries per segment
+        server_module.COMPACTION_MIN_GROWTH = 0
+        try:
+            seg_store = KeyValueStore()
+            try:
+                # "seg_doomed" lives in the oldest segment, next to values that never change, so
+                # that segment never has enough garbage to get merged itself.
+                expected = {"seg_doomed": b"old_value"}
+                seg_store.put("seg_doomed", "old_value")
+                for i in range(60):
+                    key, value = f"seg_{i:03d}", f"first_{i:03d}_" + "v" * 50
+                    seg_store.put(key, value)
+                    expected[key] = value.encode("utf-8")
+                # Its tombstone lands in a newer segment, which the overwrites below fill with garbage.
+                seg_store.delete("seg_doomed")
+                expected["seg_doomed"] = None
+                for round_number in range(3):
+                    for i in range(12, 60):
+                        key, value = f"seg_{i:03d}", f"round_{round_number}_{i:03d}_" + "w" * 40
+                        seg_store.put(key, value)
+                        expected[key] = value.encode("utf-8")
+                    seg_store.delete(f"seg_{59 - round_number:03d}")
+                    expected[f"seg_{59 - round_number:03d}"] = None
+
+                # Wait for the background cleanup the writer kicked off to finish.
+                deadline = time.time() + 10
+                while seg_store._compacting and time.time() < deadline:
+                    time.sleep(0.05)
+                with seg_store._compaction_lock:
+                    segment_ids = [segment.seg_id for segment in seg_store.segments]
+                    oldest_path = seg_store.segments[0].path
+                assert len(segment_ids) > 1, "Expected the store to roll over into several segments"
+                assert segment_ids[-1] > len(segment_ids), f"Expected background merges, still have segments {segment_ids}"
+                assert segment_ids[0] == 1, "Expected the oldest segment to still be there"
+                with open(oldest_path, "rb") as f:
+                    assert b"old_value" in f.read(), "Expected the oldest segment to be left alone"
+                check_store(seg_store, expected)
+            finally:
+                seg_store.close()
+
+            # The deleted value is still in the oldest segment, so its tombstone must have survived
+            # every merge that didn't include that segment.
+            seg_store = KeyValueStore()
+            try:
+                check_store(seg_store, expected)
+                seg_store.compact()
+                check_store(seg_store, expected)
+            finally:
+                seg_store.close()
+            seg_store = KeyValueStore()
+            try:
+                check_store(seg_store, expected)
+            finally:
+                seg_store.close()
+        finally:
+            server_module.DATA_FILE, server_module.SEGMENT_MAX_SIZE, server_module.COMPACTION_MIN_GROWTH = saved
+        print("Test 10: Segments and background compaction passed.")
+
         print("\nAll tests passed successfully! 🎉")
 
     except AssertionError as e:
@@ -104,8 +249,11 @@ def run_tests():
     finally:
         # 3. Shut down the server and exit
         print("Shutting down the server...")
-        server.shutdown()
-        server_thread.join()
+        if server_running:
+            server.shutdown()
+            server_thread.join()
+            server.server_close()
+            kv_store.close()
         print("Server shut down. The script will now exit.")
 
 if __name__ == '__main__':